@@ -17,20 +17,20 @@ train_examples, val_examples = examples['train'], examples['validation']
 
 logging.info("Build/load vocab")
 try:
-    tokenizer_en = tfds.features.text.SubwordTextEncoder.load_from_file("/data/vocab.en")
+    tokenizer_en = tfds.deprecated.text.SubwordTextEncoder.load_from_file("/data/vocab.en")
     logging.info("Loaded vocab for english from file")
 except:
     logging.info("No vocab was found, building...")
-    tokenizer_en = tfds.features.text.SubwordTextEncoder.build_from_corpus(
+    tokenizer_en = tfds.deprecated.text.SubwordTextEncoder.build_from_corpus(
         (en.numpy() for pt, en in train_examples), target_vocab_size=2**13)
     tokenizer_en.save_to_file("/data/vocab.en")
 
 try:
-    tokenizer_pt = tfds.features.text.SubwordTextEncoder.load_from_file("/data/vocab.pt")
+    tokenizer_pt = tfds.deprecated.text.SubwordTextEncoder.load_from_file("/data/vocab.pt")
     logging.info("Loaded vocab for portuguese from file")
 except:
     logging.info("No vocab was found, building...")
-    tokenizer_pt = tfds.features.text.SubwordTextEncoder.build_from_corpus(
+    tokenizer_pt = tfds.deprecated.text.SubwordTextEncoder.build_from_corpus(
         (pt.numpy() for pt, en in train_examples), target_vocab_size=2**13)
     tokenizer_pt.save_to_file("/data/vocab.pt")
 
@@ -10,7 +10,8 @@ class DecodingStrategy(metaclass=ABCMeta):
     @abstractmethod
     def select(self, logits):
         """
-        Takes a tensor 1-d tensor "logits" and returns an index (scalar int tensor)
+        Takes a [batch_size, vocab_size] logits tensor and returns one selected index per row
+        (a [batch_size] int tensor)
         :param logits:
         :return:
         """
@@ -18,12 +19,12 @@ class DecodingStrategy(metaclass=ABCMeta):
 
 
 class RandomSamplingStrategy(DecodingStrategy):
-    
+
     def __init__(self, temperature=1.0):
         self.temperature = tf.convert_to_tensor(temperature)
 
     def select(self, logits):
-        return tf.random.categorical(logits / self.temperature, num_samples=1)[0, 0]
+        return tf.random.categorical(logits / self.temperature, num_samples=1)[:, 0]
 
 
 class TopKSamplingStrategy(DecodingStrategy):
@@ -34,35 +35,53 @@ class TopKSamplingStrategy(DecodingStrategy):
 
     def select(self, logits):
         values, indices = tf.math.top_k(logits / self.temperature, k=self.k)
-        selection = tf.random.categorical(values , num_samples=1)
-        return indices[0, selection[0, 0]]
+        selection = tf.random.categorical(values, num_samples=1)[:, 0]
+        return tf.gather(indices, selection, batch_dims=1)
 
 
-def decode_encoded(seed_encoded, model, end_token_idx, strategy, max_len=100):
+def decode_encoded_batch(seeds_encoded, model, end_token_idx, strategy, max_len=100):
     """
-
-    :param seed_encoded:
+    Decodes a batch of equal-length seeds in lockstep, so the model runs once per token on
+    batch size len(seeds_encoded) instead of once per token and sequence
+    :param seeds_encoded: list of equal-length encoded seeds
     :param model:
+    :param end_token_idx:
     :param strategy:
-    :return:
+    :param max_len:
+    :return: list of decoded token id lists
     """
-    seed_encoded = list(seed_encoded)
+    decoded = tf.convert_to_tensor(seeds_encoded, dtype=tf.int64)
+    done = tf.zeros([decoded.shape[0]], dtype=tf.bool)
 
     for i in range(max_len):
-        seed_tensor = tf.convert_to_tensor(seed_encoded)[tf.newaxis, :]
-        mask = transformer.create_look_ahead_mask(tf.shape(seed_tensor)[1])
+        mask = transformer.create_masks(decoded)
 
         # Get logits for next token
-        logits, _ = model(seed_tensor, training=False, look_ahead_mask=mask)
+        logits, _ = model(decoded, training=False, look_ahead_mask=mask)
         logits = logits[:, -1, :]
 
-        new_token = strategy.select(logits)
+        new_tokens = tf.cast(strategy.select(logits), tf.int64)
+        # Finished rows keep emitting padding
+        new_tokens = tf.where(done, tf.zeros_like(new_tokens), new_tokens)
 
-        seed_encoded.append(new_token.numpy())
-        if new_token == end_token_idx:
+        decoded = tf.concat([decoded, new_tokens[:, tf.newaxis]], axis=1)
+        done = tf.logical_or(done, tf.equal(new_tokens, end_token_idx))
+        if bool(tf.reduce_all(done)):
             break
 
-    return seed_encoded
+    # Strip the padding emitted after each row finished
+    return [[token for token in row if token != 0] for row in decoded.numpy().tolist()]
+
+
+def decode_encoded(seed_encoded, model, end_token_idx, strategy, max_len=100):
+    """
+
+    :param seed_encoded:
+    :param model:
+    :param strategy:
+    :return:
+    """
+    return decode_encoded_batch([list(seed_encoded)], model, end_token_idx, strategy, max_len)[0]
 
 
 def decode(seed_text, vocab, model, strategy, max_len):
@@ -1,28 +1,43 @@
 import tensorflow as tf
 import time
 import json
+import random
 from absl import app, flags
 from model import transformer
 from preprocess import get_vocab
 from pathlib import Path
-from decode import decode_encoded, RandomSamplingStrategy, TopKSamplingStrategy
+from decode import decode_encoded_batch, RandomSamplingStrategy, TopKSamplingStrategy
 
 
 def get_dataset(dataset_path: Path, batch_size: int, take: int=None, shuffle_buffer: int=1000):
 
-    def parse_json(json_string_tensor):
-        return tf.constant(json.loads(json_string_tensor.numpy())["encoded"], dtype=tf.int64)
+    def _parse_function(serialized_example):
+        # RaggedFeature yields the 1-D token vector directly, skipping the sparse->dense
+        # detour of VarLenFeature
+        return tf.io.parse_single_example(serialized_example, {"text": tf.io.RaggedFeature(tf.int64)})["text"]
 
-    def parse_json_fn(text):
-        return tf.py_function(parse_json, inp=[text], Tout=tf.int64)
-
-    ds = tf.data.TextLineDataset(str(dataset_path))
-    ds = ds.map(parse_json_fn)
-    ds = ds.padded_batch(batch_size, padded_shapes=(-1,))
+    files = tf.data.Dataset.list_files(str(dataset_path) + "*", shuffle=False)
+    ds = files.interleave(tf.data.TFRecordDataset, cycle_length=16, num_parallel_calls=tf.data.AUTOTUNE)
+    ds = ds.map(_parse_function, num_parallel_calls=tf.data.AUTOTUNE)
     if take is not None:
         ds = ds.shuffle(shuffle_buffer, seed=42)
         ds = ds.take(take)
-    ds = ds.prefetch(100)
+    # Batch similar-length sequences together; attention cost is O(L^2) so padding every
+    # batch to its longest member wastes real compute
+    boundaries = [64, 128, 256, 384, 512]
+    ds = ds.apply(tf.data.experimental.bucket_by_sequence_length(lambda x: tf.shape(x),
+                                                                 boundaries,
+                                                                 [batch_size] * (len(boundaries) + 1),
+                                                                 padded_shapes=[None]))
+    ds = ds.prefetch(tf.data.AUTOTUNE)
+
+    opts = tf.data.Options()
+    opts.deterministic = False
+    opts.experimental_optimization.map_and_batch_fusion = True
+    opts.experimental_optimization.map_parallelization = True
+    opts.experimental_optimization.parallel_batch = True
+    opts.autotune.enabled = True
+    ds = ds.with_options(opts)
 
     return ds
 
@@ -35,95 +50,121 @@ def render_markdown(gt_example, random_sampled, top_5):
     """.format(gt_example, random_sampled, top_5)
 
 
-def evaluate(vocab_path: Path, checkpoint_path: Path, dataset_path: Path, batch_size: int, take: int=None,
-             shuffle_buffer: int=None):
-    # Vocab
-    vocab = get_vocab(str(vocab_path))
+class Evaluator:
+    """
+    Holds the model and the model-bound evaluation_step tf.function. Repeated evaluation rounds
+    (e.g. with --wait_for_checkpoint) reuse the same traced function instead of rebuilding and
+    retracing it every round.
+    """
+
+    def __init__(self, vocab_path: Path, checkpoint_path: Path):
+        self.checkpoint_path = checkpoint_path
 
-    # Load model
-    transformer_decoder = transformer.TransformerOnlyDecoder(vocab.vocab_size)
+        # Vocab
+        self.vocab = get_vocab(str(vocab_path))
 
-    # Global step counter
-    global_step = tf.Variable(0, name="global_step", trainable=False, dtype=tf.int64)
+        # Model
+        self.transformer_decoder = transformer.TransformerOnlyDecoder(self.vocab.vocab_size)
 
-    # Restore from checkpoint
-    ckpt = tf.train.Checkpoint(transformer_decoder=transformer_decoder, global_step=global_step)
-    ckpt_manager = tf.train.CheckpointManager(ckpt, str(checkpoint_path), max_to_keep=5)
-    if ckpt_manager.latest_checkpoint:
-        ckpt.restore(ckpt_manager.latest_checkpoint)
-        print("Restored checkpoint from: {}".format(ckpt_manager.latest_checkpoint))
-    else:
-        raise RuntimeError("Couldn't load from checkpoint")
+        # Global step counter
+        self.global_step = tf.Variable(0, name="global_step", trainable=False, dtype=tf.int64)
 
-    # Dataset
-    ds = get_dataset(str(dataset_path), batch_size=batch_size, take=take, shuffle_buffer=shuffle_buffer)
+        # Checkpointing
+        self.ckpt = tf.train.Checkpoint(transformer_decoder=self.transformer_decoder, global_step=self.global_step)
+        self.ckpt_manager = tf.train.CheckpointManager(self.ckpt, str(checkpoint_path), max_to_keep=5)
 
-    # Metrics
-    token_accuracy = tf.keras.metrics.SparseCategoricalAccuracy("token_accuracy")
-    log_ppl = tf.keras.metrics.Mean("log_perplexity")
+        # Metrics
+        self.token_accuracy = tf.keras.metrics.SparseCategoricalAccuracy("token_accuracy")
+        self.log_ppl = tf.keras.metrics.Mean("log_perplexity")
 
-    eval_step_signature = [tf.TensorSpec(shape=(None, None), dtype=tf.int64)]
+        eval_step_signature = [tf.TensorSpec(shape=(None, None), dtype=tf.int64)]
+        self.evaluation_step = tf.function(self._evaluation_step, input_signature=eval_step_signature,
+                                           jit_compile=True)
 
-    @tf.function(input_signature=eval_step_signature, experimental_relax_shapes=True)
-    def evaluation_step(batch):
+    def _evaluation_step(self, batch):
         batch_inp = batch[:, :-1]
         batch_tar = batch[:, 1:]
 
         # Apply model
         mask = transformer.create_masks(batch_inp)
-        logits, _ = transformer_decoder(batch_inp, False, mask)  # TODO: Visualise attentions
-
-        # Update metrics
-        padding_mask = tf.math.logical_not(tf.math.equal(batch_tar, 0))
-        token_accuracy(batch_tar, logits, sample_weight=padding_mask)
-        log_ppl(tf.nn.sparse_softmax_cross_entropy_with_logits(batch_tar, logits) / tf.math.log(2.0),
-                sample_weight=padding_mask)
-
-    for batch in ds:
-        evaluation_step(batch)
-
-    # Decode some examples
-    gt_examples = []
-    random_sampling_examples = []
-    top_5_sampling_examples = []
-    for example in get_dataset(str(dataset_path), batch_size=1, take=None).shuffle(1000, seed=42).take(5):
+        logits, _ = self.transformer_decoder(batch_inp, False, mask)  # TODO: Visualise attentions
+
+        # Update metrics (float sample weights keep the metric updates free of dynamic gathers)
+        padding_mask = tf.cast(tf.math.logical_not(tf.math.equal(batch_tar, 0)), tf.float32)
+        self.token_accuracy(batch_tar, logits, sample_weight=padding_mask)
+        self.log_ppl(tf.nn.sparse_softmax_cross_entropy_with_logits(batch_tar, logits) / tf.math.log(2.0),
+                     sample_weight=padding_mask)
+
+    def evaluate(self, dataset_path: Path, batch_size: int, take: int=None, shuffle_buffer: int=None):
+        # Restore from checkpoint
+        if self.ckpt_manager.latest_checkpoint:
+            self.ckpt.restore(self.ckpt_manager.latest_checkpoint)
+            print("Restored checkpoint from: {}".format(self.ckpt_manager.latest_checkpoint))
+        else:
+            raise RuntimeError("Couldn't load from checkpoint")
+
+        # Dataset
+        ds = get_dataset(str(dataset_path), batch_size=batch_size, take=take, shuffle_buffer=shuffle_buffer)
+
+        self.token_accuracy.reset_states()
+        self.log_ppl.reset_states()
+
+        # Reservoir-sample 5 examples for the qualitative decoding below while the metrics
+        # pass walks the dataset, instead of rescanning and re-parsing it a second time
+        rng = random.Random(42)
+        examples = []
+        num_seen = 0
+        for batch in ds:
+            self.evaluation_step(batch)
+
+            for row in batch.numpy():
+                num_seen += 1
+                if len(examples) < 5:
+                    examples.append(row[row != 0])
+                elif rng.randrange(num_seen) < 5:
+                    examples[rng.randrange(5)] = row[row != 0]
+
+        # Decode the sampled examples, batched so all seeds step through the model in lockstep
+        gt_examples = [self.vocab.decode(example) for example in examples]
         # Use the first 4 tokens as seed
-        gt_examples.append(vocab.decode(example[0].numpy()))
-        random_sampling_examples.append(
-            vocab.decode(decode_encoded(example[0][:4].numpy(), transformer_decoder, vocab.end_idx,
-                                        RandomSamplingStrategy())))
-        top_5_sampling_examples.append(
-            vocab.decode(decode_encoded(example[0][:4].numpy(), transformer_decoder, vocab.end_idx,
-                                        TopKSamplingStrategy(5))))
-
-    # Tensorboard events
-    eval_log_dir = str(checkpoint_path / (dataset_path.stem + "_eval"))
-    eval_summary_writer = tf.summary.create_file_writer(eval_log_dir)
-
-    with eval_summary_writer.as_default():
-        tf.summary.scalar("token_accuracy", token_accuracy.result(), global_step.numpy())
-        tf.summary.scalar("log_perplexity", log_ppl.result(), global_step.numpy())
-
-        # Write decoded examples..
-        for i, (gt_example, rand_ex, top_5_ex) in enumerate(zip(gt_examples,
-                                                                random_sampling_examples,
-                                                                top_5_sampling_examples)):
-            tf.summary.text("decoded_example_{}".format(i + 1),
-                            tf.convert_to_tensor(render_markdown(gt_example, rand_ex, top_5_ex)),
-                            global_step.numpy())
-
-    return {"token_accuracy": float(token_accuracy.result().numpy()), "log_perplexity": float(log_ppl.result().numpy())}
+        seeds = [example[:4] for example in examples]
+        random_sampling_examples = [
+            self.vocab.decode(decoded) for decoded in
+            decode_encoded_batch(seeds, self.transformer_decoder, self.vocab.end_idx, RandomSamplingStrategy())]
+        top_5_sampling_examples = [
+            self.vocab.decode(decoded) for decoded in
+            decode_encoded_batch(seeds, self.transformer_decoder, self.vocab.end_idx, TopKSamplingStrategy(5))]
+
+        # Tensorboard events
+        eval_log_dir = str(self.checkpoint_path / (dataset_path.stem + "_eval"))
+        eval_summary_writer = tf.summary.create_file_writer(eval_log_dir)
+
+        with eval_summary_writer.as_default():
+            tf.summary.scalar("token_accuracy", self.token_accuracy.result(), self.global_step.numpy())
+            tf.summary.scalar("log_perplexity", self.log_ppl.result(), self.global_step.numpy())
+
+            # Write decoded examples..
+            for i, (gt_example, rand_ex, top_5_ex) in enumerate(zip(gt_examples,
+                                                                    random_sampling_examples,
+                                                                    top_5_sampling_examples)):
+                tf.summary.text("decoded_example_{}".format(i + 1),
+                                tf.convert_to_tensor(render_markdown(gt_example, rand_ex, top_5_ex)),
+                                self.global_step.numpy())
+
+        return {"token_accuracy": float(self.token_accuracy.result().numpy()),
+                "log_perplexity": float(self.log_ppl.result().numpy())}
 
 
 def main(argv):
     checkpoint_path = Path(flags.FLAGS.checkpoint_path)
+    evaluator = Evaluator(Path(flags.FLAGS.vocab), checkpoint_path)
     try:
         while True:
             latest_checkpoint = tf.train.latest_checkpoint(str(checkpoint_path))
             start_time = time.time()
             print("Starting evaluation of checkpoint '{}'".format(latest_checkpoint))
-            res = evaluate(Path(flags.FLAGS.vocab), checkpoint_path, Path(flags.FLAGS.data),
-                     flags.FLAGS.batch_size, flags.FLAGS.take, flags.FLAGS.shuffle_buffer)
+            res = evaluator.evaluate(Path(flags.FLAGS.data), flags.FLAGS.batch_size, flags.FLAGS.take,
+                                     flags.FLAGS.shuffle_buffer)
             print("Evaluation of checkpoint '{}' finished in {}s".format(latest_checkpoint, time.time() - start_time))
             print(json.dumps(res))
 
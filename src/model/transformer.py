@@ -1,3 +1,4 @@
+import functools
 import tensorflow as tf
 import numpy as np
 import hparams as hp
@@ -46,15 +47,30 @@ def create_look_ahead_mask(size):
     return mask  # (seq_len, seq_len)
 
 
+@functools.lru_cache(maxsize=32)
+def static_look_ahead_mask(size):
+    """
+    Memoized look-ahead mask for a static (Python int) sequence length. With bucketed
+    batching only a handful of lengths occur per run, so each mask constant is built once
+    """
+    return create_look_ahead_mask(size)
+
+
 def create_masks(tar):
     # Used in the 1st attention block in the decoder.
     # It is used to pad and mask future tokens in the input received by
     # the decoder.
-    look_ahead_mask = create_look_ahead_mask(tf.shape(tar)[1])
+    seq_len = tar.shape[1]
+    if seq_len is not None:
+        look_ahead_mask = static_look_ahead_mask(int(seq_len))
+    else:
+        look_ahead_mask = create_look_ahead_mask(tf.shape(tar)[1])
     dec_target_padding_mask = create_padding_mask(tar)
     combined_mask = tf.maximum(dec_target_padding_mask, look_ahead_mask)
 
-    return combined_mask
+    # Additive form: large negative on masked positions, 0 elsewhere, so attention just adds
+    # it to the logits instead of rescaling a 0/1 mask on every call
+    return combined_mask * -1e9
 
 
 def scaled_dot_product_attention(q, k, v, mask):
@@ -68,8 +84,8 @@ def scaled_dot_product_attention(q, k, v, mask):
       q: query shape == (..., seq_len_q, depth)
       k: key shape == (..., seq_len_k, depth)
       v: value shape == (..., seq_len_v, depth_v)
-      mask: Float tensor with shape broadcastable
-            to (..., seq_len_q, seq_len_k). Defaults to None.
+      mask: Additive float tensor (large negative on masked positions) with shape
+            broadcastable to (..., seq_len_q, seq_len_k). Defaults to None.
 
     Returns:
       output, attention_weights
@@ -78,12 +94,12 @@ def scaled_dot_product_attention(q, k, v, mask):
     matmul_qk = tf.matmul(q, k, transpose_b=True)  # (..., seq_len_q, seq_len_k)
 
     # scale matmul_qk
-    dk = tf.cast(tf.shape(k)[-1], tf.float32)
+    dk = tf.cast(tf.shape(k)[-1], matmul_qk.dtype)
     scaled_attention_logits = matmul_qk / tf.math.sqrt(dk)
 
-    # add the mask to the scaled tensor.
+    # add the (already additive) mask to the scaled tensor.
     if mask is not None:
-        scaled_attention_logits += (mask * -1e9)
+        scaled_attention_logits += tf.cast(mask, scaled_attention_logits.dtype)
 
     # softmax is normalized on the last axis (seq_len_k) so that the scores
     # add up to 1.
@@ -256,8 +272,8 @@ class Encoder(tf.keras.layers.Layer):
 
         # adding embedding and position encoding.
         x = self.embedding(x)  # (batch_size, input_seq_len, d_model)
-        x *= tf.math.sqrt(tf.cast(self.d_model, tf.float32))
-        x += self.pos_encoding[:, :seq_len, :]
+        x *= tf.math.sqrt(tf.cast(self.d_model, x.dtype))
+        x += tf.cast(self.pos_encoding[:, :seq_len, :], x.dtype)
 
         x = self.dropout(x, training=training)
 
@@ -291,9 +307,11 @@ class Decoder(tf.keras.layers.Layer):
         # tf.summary.histogram("embeddings", x)
         # tf.summary.histogram("embeddings_weights", self.embedding.embeddings.value())
 
-        x *= tf.math.sqrt(tf.cast(self.d_model, tf.float32))
+        # Scale and positional constants follow the layer's compute dtype so the half-precision
+        # policies don't hit float32/float16 mixed-dtype errors
+        x *= tf.math.sqrt(tf.cast(self.d_model, x.dtype))
         # tf.summary.histogram("scaled_embeddings", x)
-        x += self.pos_encoding[:, :seq_len, :]
+        x += tf.cast(self.pos_encoding[:, :seq_len, :], x.dtype)
         # tf.summary.histogram("embeddings_and_pos", x)
         x = self.dropout(x, training=training)
 
@@ -356,8 +374,11 @@ class TransformerOnlyDecoder(tf.keras.Model):
         # dec_output.shape == (batch_size, tar_seq_len, d_model)
         dec_output, attention_weights = self.decoder(tar, None, training, look_ahead_mask, None)
 
-        # Final projection to vocabulary => logits
-        final_output = tf.matmul(dec_output, self.decoder.embedding.embeddings, transpose_b=True)
+        # Final projection to vocabulary => logits. Keep the logits in fp32 so the
+        # cross entropy stays numerically stable under mixed precision
+        final_output = tf.matmul(dec_output, tf.cast(self.decoder.embedding.embeddings, dec_output.dtype),
+                                 transpose_b=True)
+        final_output = tf.cast(final_output, tf.float32)
         # final_output += self.logits_bias
         tf.summary.histogram("logits", final_output)
         # tf.summary.histogram("logits_bias_weights", self.logits_bias.value())
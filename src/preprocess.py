@@ -6,7 +6,7 @@ import tensorflow_datasets as tfds
 from pathlib import Path
 
 
-class Vocabulary(tfds.features.text.SubwordTextEncoder):
+class Vocabulary(tfds.deprecated.text.SubwordTextEncoder):
     """
     Extends the SubwordTextEncoder with two additional special tokens:
      - <START>
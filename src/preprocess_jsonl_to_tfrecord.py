@@ -0,0 +1,45 @@
+import logging
+import json
+import tensorflow as tf
+from pathlib import Path
+
+
+def convert(input_file: Path, output_prefix: Path, num_shards: int):
+    writers = [tf.io.TFRecordWriter("{}-{:05d}-of-{:05d}".format(str(output_prefix), shard, num_shards))
+               for shard in range(num_shards)]
+
+    num_examples = 0
+    logging.info("Opening input file")
+    with open(str(input_file), "r") as f:
+        for i, line in enumerate(f):
+            encoded = json.loads(line)["encoded"]
+            example = tf.train.Example(features=tf.train.Features(feature={
+                "text": tf.train.Feature(int64_list=tf.train.Int64List(value=encoded))
+            }))
+            writers[i % num_shards].write(example.SerializeToString())
+            num_examples += 1
+            if num_examples % 10000 == 0:
+                logging.info("Wrote {} examples so far...".format(num_examples))
+
+    for writer in writers:
+        writer.close()
+    logging.info("Finished writing {} examples to {} shards".format(num_examples, num_shards))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Converts an encoded jsonl dataset into sharded TFRecord files")
+    parser.add_argument("--input", required=True)
+    parser.add_argument("--output", required=True, help="Output file prefix, shards get a -XXXXX-of-XXXXX suffix")
+    parser.add_argument("--num-shards", type=int, default=8)
+    parser.add_argument("--verbose", action="store_true")
+
+    params = parser.parse_args()
+
+    if params.verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+    else:
+        logging.getLogger().setLevel(logging.INFO)
+
+    convert(Path(params.input), Path(params.output), params.num_shards)
@@ -1,8 +1,10 @@
 import tensorflow as tf
 import numpy as np
+import math
+import sys
 import time
-import json
 import hparams as hp
+from concurrent.futures import ThreadPoolExecutor
 from model import transformer
 from optimizer import get_optimizer
 from preprocess import get_vocab
@@ -10,137 +12,338 @@ from pathlib import Path
 from absl import app, flags
 
 # Training hparams
-hp.add("shuffle_buffer", 1, help="Shuffle buffer")
+hp.add("shuffle_buffer", 10000, help="Shuffle buffer size, in examples. Applied before batching, where each "
+                                     "buffered element is a single encoded paragraph")
 hp.add("max_tokens", 100, help="Max tokens")
 hp.add("max_seq_len", 600, help="Max sequence len")
+hp.add("cache_dataset", True, help="Cache the parsed dataset in memory between epochs")
+hp.add("dataset_cache_path", "", help="Cache the parsed dataset to this file instead of in memory, persisting it "
+                                      "across runs (first run materializes, later runs read at disk speed)")
+hp.add("precision_policy", "float32", enum_values=["float32", "mixed_float16", "mixed_bfloat16"], dtype=list,
+       help="Compute dtype policy. mixed_float16 needs loss scaling (added automatically), mixed_bfloat16 doesn't")
+hp.add("grad_accum_steps", 1, help="Accumulate gradients over this many steps before applying them")
 
 
 def get_dataset(dataset_path: Path, max_tokens: int, max_seq_len: int, shuffle_buffer: int, skip: int = 0):
-    def parse_json(json_string_tensor):
-        encoded = json.loads(json_string_tensor.numpy())["encoded"]
-        return tf.constant(encoded, dtype=tf.int64, shape=[len(encoded)])
-
-    def parse_json_fn(text):
-        return tf.py_function(parse_json, inp=[text], Tout=tf.int64)
-
-    boundaries = [i for i in range(1, max_seq_len + 1) if max_tokens % i == 0]
-    batch_sizes = [int(max_tokens / i) for i in range(1, max_seq_len + 1) if max_tokens % i == 0] + [1]
-
-    ds = tf.data.TextLineDataset(str(dataset_path))
-    ds = ds.map(parse_json_fn)
+    def _parse_function(serialized_example):
+        # RaggedFeature yields the 1-D token vector directly, skipping the sparse->dense
+        # detour of VarLenFeature
+        return tf.io.parse_single_example(serialized_example, {"text": tf.io.RaggedFeature(tf.int64)})["text"]
+
+    # Power-of-two buckets keep the number of distinct padded shapes (and hence tf.function
+    # traces) at O(log max_seq_len) instead of one per divisor of max_tokens
+    boundaries = [b for b in (32, 64, 128, 256, 512) if b <= max_seq_len]
+    batch_sizes = [max(1, max_tokens // b) for b in boundaries] + [1]
+
+    files = tf.data.Dataset.list_files(str(dataset_path) + "*", shuffle=True, seed=42)
+    ds = files.interleave(tf.data.TFRecordDataset, cycle_length=16, num_parallel_calls=tf.data.AUTOTUNE)
+    ds = ds.map(_parse_function, num_parallel_calls=tf.data.AUTOTUNE)
+    if hp.get("dataset_cache_path"):
+        ds = ds.cache(hp.get("dataset_cache_path"))
+    elif hp.get("cache_dataset"):
+        ds = ds.cache()
+    ds = ds.shuffle(buffer_size=shuffle_buffer, seed=42, reshuffle_each_iteration=True)
     ds = ds.apply(tf.data.experimental.bucket_by_sequence_length(lambda x: tf.shape(x),
                                                                  boundaries,
                                                                  batch_sizes, padded_shapes=[None]))
-    ds = ds.shuffle(buffer_size=shuffle_buffer, seed=42)
+    # Compute the attention mask on the CPU side of the pipeline so it overlaps with training
+    # compute and the accelerator step is pure model math
+    ds = ds.map(lambda batch: (batch, transformer.create_masks(batch[:, :-1])),
+                num_parallel_calls=tf.data.AUTOTUNE)
     ds = ds.repeat()
     ds = ds.skip(skip)
-    ds = ds.prefetch(100)
-
-    return ds
+    ds = ds.prefetch(tf.data.AUTOTUNE)
 
+    opts = tf.data.Options()
+    opts.deterministic = False
+    opts.experimental_optimization.map_and_batch_fusion = True
+    opts.experimental_optimization.map_parallelization = True
+    opts.experimental_optimization.parallel_batch = True
+    opts.autotune.enabled = True
+    ds = ds.with_options(opts)
 
-def train_loop(ds, transformer_decoder, global_step, num_examples_processed, ckpt_manager, optimizer, learning_rate,
-               train_summary_writer, checkpoint_every, summarize_every, continuous=True):
-    loss_object = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True, reduction='none')
-    train_step_signature = [tf.TensorSpec(shape=(None, None), dtype=tf.int64)]
-
-    def calculate_loss(real, pred):
-        # Masks padded tokens from loss_object
-        mask = tf.math.logical_not(tf.math.equal(real, 0))
-        loss_ = loss_object(real, pred)
+    return ds
 
-        return tf.reduce_mean(tf.boolean_mask(loss_, mask))
 
-    @tf.function(input_signature=train_step_signature, experimental_relax_shapes=True)
-    def train_step(batch):
+class Trainer:
+    """
+    Holds the model-bound train_step tf.function. Building it once in __init__ means repeated
+    train_loop calls reuse the same traced function instead of retracing from scratch.
+    """
+
+    def __init__(self, strategy, transformer_decoder, optimizer, learning_rate, global_step, train_summary_writer,
+                 summarize_every, grad_accum_steps=1):
+        self.strategy = strategy
+        self.transformer_decoder = transformer_decoder
+        self.optimizer = optimizer
+        self.learning_rate = learning_rate
+        self.global_step = global_step
+        self.train_summary_writer = train_summary_writer
+        self.summarize_every = summarize_every
+        self.loss_object = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True, reduction='none')
+        self.loss_scaling = isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer)
+        self.grad_accum_steps = grad_accum_steps
+        self.accumulated_gradients = None
+        self.accum_counter = 0
+
+        # Only forward/backward is XLA-compiled: the optimizer update touches the mirrored
+        # variable copies of all replicas (and the accum path creates variables), neither of
+        # which is allowed inside a jit-compiled cluster. None of the functions dispatched
+        # through strategy.run can carry an input_signature, since they are handed PerReplica
+        # values rather than plain tensors
+        self._forward_backward_fn = tf.function(self._forward_backward, reduce_retracing=True, jit_compile=True)
+        if grad_accum_steps > 1:
+            self.train_step = self._train_step_accum
+            self._apply_fn = tf.function(self._apply_accumulated)
+            # The jit-compiled function can't be the outermost function under strategy.run
+            # either (XLA then reaches across replica variable copies), so wrap it
+            self._replica_forward_backward = tf.function(self._forward_backward_step, reduce_retracing=True)
+        else:
+            self._replica_step = tf.function(self._train_step, reduce_retracing=True)
+            self.train_step = tf.function(self._distributed_train_step, reduce_retracing=True)
+            self.multi_step = tf.function(self._multi_step, reduce_retracing=True)
+
+    def _calculate_loss(self, real, pred):
+        # Masks padded tokens from loss_object. Multiply-and-sum keeps the shapes static,
+        # unlike boolean_mask which yields a dynamically sized tensor every step
+        loss_ = self.loss_object(real, pred)
+        mask = tf.cast(tf.math.logical_not(tf.math.equal(real, 0)), loss_.dtype)
+
+        return tf.reduce_sum(loss_ * mask) / (tf.reduce_sum(mask) + 1e-8)
+
+    def _forward_backward(self, batch, mask):
         tar_inp = batch[:, :-1]
         tar_real = batch[:, 1:]
 
-        mask = transformer.create_masks(tar_inp)
-
-        with train_summary_writer.as_default():
-            with tf.summary.record_if(tf.math.equal(tf.math.mod(global_step, summarize_every), 0)):
-                with tf.GradientTape() as tape:
-                    predictions, _ = transformer_decoder(tar_inp, True, mask)
-                    loss = calculate_loss(tar_real, predictions)
-
-                vars = transformer_decoder.trainable_variables
-                gradients = tape.gradient(loss, vars)
-                optimizer.apply_gradients(zip(gradients, transformer_decoder.trainable_variables))
-
-                for i in range(len(vars)):
-                    tf.summary.scalar("gradient/" + vars[i].name, tf.linalg.norm(gradients[i]))
-
+        with tf.GradientTape() as tape:
+            predictions, _ = self.transformer_decoder(tar_inp, True, mask)
+            loss = self._calculate_loss(tar_real, predictions)
+            # MirroredStrategy sums gradients across replicas, so scale the per-replica loss
+            # down to make the aggregated gradients a cross-replica mean
+            replica_loss = loss / self.strategy.num_replicas_in_sync
+            scaled_loss = self.optimizer.get_scaled_loss(replica_loss) if self.loss_scaling else replica_loss
+
+        gradients = tape.gradient(scaled_loss, self.transformer_decoder.trainable_variables)
+        if self.loss_scaling:
+            gradients = self.optimizer.get_unscaled_gradients(gradients)
+
+        return loss, gradients, tf.cast(tf.shape(batch)[0], tf.int64)
+
+    def _forward_backward_step(self, batch, mask):
+        return self._forward_backward_fn(batch, mask)
+
+    def _train_step(self, batch, mask):
+        loss, gradients, num_examples = self._forward_backward_fn(batch, mask)
+        self.optimizer.apply_gradients(zip(gradients, self.transformer_decoder.trainable_variables))
+
+        return loss, tf.linalg.global_norm(gradients), num_examples
+
+    def _distributed_train_step(self, batch, mask):
+        loss, gradient_norm, num_examples = self.strategy.run(self._replica_step, args=(batch, mask))
+        loss = self.strategy.reduce(tf.distribute.ReduceOp.MEAN, loss, axis=None)
+
+        # Printing from inside the traced function avoids the .numpy() host sync a
+        # Python-side print would force on every 100th step
+        if tf.equal(tf.math.mod(self.global_step, 100), 0):
+            tf.print("Step:", self.global_step, "\tLoss:", loss, output_stream=sys.stdout)
+
+        return (loss,
+                self.strategy.reduce(tf.distribute.ReduceOp.MEAN, gradient_norm, axis=None),
+                self.strategy.reduce(tf.distribute.ReduceOp.SUM, num_examples, axis=None))
+
+    def _accumulate(self, *gradients):
+        # Runs in replica context: assign_add on the ON_READ accumulators only touches the
+        # local copy, so no cross-replica traffic happens during the accumulation window
+        for accumulated, gradient in zip(self.accumulated_gradients, gradients):
+            accumulated.assign_add(gradient)
+
+        return tf.linalg.global_norm(gradients)
+
+    def _apply_accumulated(self, *gradients):
+        # The gradients were already summed across replicas when the accumulators were read,
+        # so the optimizer must not aggregate them again
+        self.optimizer.apply_gradients(zip(gradients, self.transformer_decoder.trainable_variables),
+                                       skip_gradients_aggregation=True)
+
+    def _train_step_accum(self, batch, mask):
+        per_replica_loss, per_replica_gradients, per_replica_num_examples = \
+            self.strategy.run(self._replica_forward_backward, args=(batch, mask))
+
+        if self.accumulated_gradients is None:
+            # Created lazily after the first forward/backward, which is what builds the
+            # model's weights. ON_READ/SUM gives each replica its own accumulator whose
+            # cross-replica read sums them, i.e. the allreduce is deferred until we apply
+            with self.strategy.scope():
+                self.accumulated_gradients = [
+                    tf.Variable(tf.zeros_like(v), trainable=False,
+                                synchronization=tf.VariableSynchronization.ON_READ,
+                                aggregation=tf.VariableAggregation.SUM)
+                    for v in self.transformer_decoder.trainable_variables]
+
+        per_replica_gradient_norm = self.strategy.run(self._accumulate, args=tuple(per_replica_gradients))
+
+        self.accum_counter += 1
+        if self.accum_counter == self.grad_accum_steps:
+            # Reading the accumulators here, in cross-replica context, performs the one
+            # allreduce of the window. Per-replica gradients were scaled by 1/num_replicas,
+            # so the summed read is already a cross-replica mean
+            gradients = [accumulated.read_value() / self.grad_accum_steps
+                         for accumulated in self.accumulated_gradients]
+            self.strategy.run(self._apply_fn, args=tuple(gradients))
+            for accumulated in self.accumulated_gradients:
+                accumulated.assign(tf.zeros_like(accumulated))
+            self.accum_counter = 0
+
+        loss = self.strategy.reduce(tf.distribute.ReduceOp.MEAN, per_replica_loss, axis=None)
+
+        # Same loss reporting cadence as the default path, which prints from inside its
+        # traced step
+        if tf.equal(tf.math.mod(self.global_step, 100), 0):
+            tf.print("Step:", self.global_step, "\tLoss:", loss, output_stream=sys.stdout)
+
+        return (loss,
+                self.strategy.reduce(tf.distribute.ReduceOp.MEAN, per_replica_gradient_norm, axis=None),
+                self.strategy.reduce(tf.distribute.ReduceOp.SUM, per_replica_num_examples, axis=None))
+
+    def _multi_step(self, iterator, steps):
+        # Drives `steps` train steps from a single host->device dispatch, so the Python loop
+        # only regains control when there's something to summarize or checkpoint
+        loss = tf.constant(0.0)
+        gradient_norm = tf.constant(0.0)
+        num_examples = tf.constant(0, dtype=tf.int64)
+        for _ in tf.range(steps):
+            batch, mask = next(iterator)
+            loss, gradient_norm, step_examples = self._distributed_train_step(batch, mask)
+            num_examples += step_examples
+            self.global_step.assign_add(1)
+
+        return loss, gradient_norm, num_examples
+
+    def summarize(self, loss, gradient_norm):
+        with self.train_summary_writer.as_default():
             tf.summary.scalar("loss", loss)
-            tf.summary.scalar("gradient_norm", tf.linalg.global_norm(gradients))
+            tf.summary.scalar("gradient_norm", gradient_norm)
             tf.summary.scalar("learning_rate",
-                              learning_rate if type(learning_rate) is float else learning_rate(global_step))
+                              self.learning_rate if type(self.learning_rate) is float
+                              else self.learning_rate(self.global_step))
 
-        return loss
 
-    steps_start = time.time()
+def train_loop(ds, trainer, global_step, num_examples_processed, ckpt_manager, checkpoint_every, continuous=True):
+    transformer_decoder = trainer.transformer_decoder
 
-    for batch in ds:
-        global_step.assign_add(1)
-        num_examples_processed.assign_add(tf.cast(tf.shape(batch)[0], num_examples_processed.dtype))
-        tf.summary.experimental.set_step(global_step)
+    # Checkpoints are written from a background thread so the GPU isn't idle during
+    # serialization. At most one save is in flight at a time
+    checkpoint_executor = ThreadPoolExecutor(max_workers=1)
+    pending_checkpoint = None
 
-        # Take a gradient step
-        loss = train_step(batch)
+    steps_start = time.time()
 
-        if global_step.numpy() == 1:
+    # Summary ops resolve the step variable at write time, so binding it once is enough
+    tf.summary.experimental.set_step(global_step)
+
+    # Mirror global_step in a plain Python counter so the per-step control flow below doesn't
+    # force a device->host sync via global_step.numpy()
+    step = int(global_step.numpy())
+
+    # The accumulation path keeps Python-side state between steps, so only the default path
+    # can drive several steps per tf.function call. The gcd over every cadence in the loop
+    # body (summaries, the wallclock print, checkpoints) guarantees each of them still lands
+    # exactly on a call boundary, whatever the flags are
+    steps_per_call = math.gcd(trainer.summarize_every, checkpoint_every, 1000) \
+        if trainer.grad_accum_steps == 1 else 1
+
+    iterator = iter(ds)
+    first_call = True
+    while True:
+        if steps_per_call == 1:
+            batch, mask = next(iterator)
+            global_step.assign_add(1)
+            loss, gradient_norm, num_examples = trainer.train_step(batch, mask)
+        else:
+            loss, gradient_norm, num_examples = trainer.multi_step(iterator,
+                                                                   tf.constant(steps_per_call, dtype=tf.int32))
+        step += steps_per_call
+        num_examples_processed.assign_add(num_examples)
+
+        # Write summaries from the Python side on summary steps only, keeping the writer
+        # (and its conditional) out of the traced step
+        if step % trainer.summarize_every == 0:
+            trainer.summarize(loss, gradient_norm)
+
+        if first_call:
+            first_call = False
             print("Number of trainable parameters: {}".format(
                 np.sum([np.prod(v.get_shape().as_list()) for v in transformer_decoder.trainable_variables])))
 
-        # Print intermediate metrics
-        if global_step.numpy() % 100 == 0:
-            print('Step: {}\tLoss: {:.4f}\tNum examples: {}\tTime: {:.3f}s'.format(
-                global_step.numpy(), loss, num_examples_processed.numpy(), time.time() - steps_start))
+        # Loss is printed by tf.print inside the step function; keep the host-synced
+        # wallclock print at a lower cadence
+        if step % 1000 == 0:
+            print('Step: {}\tNum examples: {}\tTime: {:.3f}s'.format(
+                step, num_examples_processed.numpy(), time.time() - steps_start))
             steps_start = time.time()
 
         # Checkpoint every X step
-        if global_step.numpy() % checkpoint_every == 0:
-            ckpt_save_path = ckpt_manager.save(checkpoint_number=global_step)
-            print("Saving checkpoint at '{}'".format(ckpt_save_path))
+        if step % checkpoint_every == 0:
+            if pending_checkpoint is not None:
+                print("Saved checkpoint at '{}'".format(pending_checkpoint.result()))
+            trainer.train_summary_writer.flush()
+            pending_checkpoint = checkpoint_executor.submit(ckpt_manager.save, checkpoint_number=step)
 
             if not continuous:
                 break
 
+    if pending_checkpoint is not None:
+        print("Saved checkpoint at '{}'".format(pending_checkpoint.result()))
+    checkpoint_executor.shutdown()
+
 
 def main(argv):
     vocab_size = get_vocab(Path(flags.FLAGS.vocab)).vocab_size
 
-    # Model
-    transformer_decoder = transformer.TransformerOnlyDecoder(vocab_size)
+    tf.keras.mixed_precision.set_global_policy(hp.get("precision_policy"))
+
+    # Synchronous data-parallel training over all visible GPUs (no-op on a single device)
+    strategy = tf.distribute.MirroredStrategy()
+    print("Number of replicas: {}".format(strategy.num_replicas_in_sync))
 
-    # Optimizer
-    optimizer, learning_rate = get_optimizer()
+    with strategy.scope():
+        # Model
+        transformer_decoder = transformer.TransformerOnlyDecoder(vocab_size)
 
-    # Counters
-    global_step = tf.Variable(0, name="global_step", trainable=False, dtype=tf.int64)
-    num_examples_processed = tf.Variable(0, name="num_examples_processed", trainable=False, dtype=tf.int64)
+        # Optimizer
+        optimizer, learning_rate = get_optimizer()
+        if hp.get("precision_policy") == "mixed_float16":
+            # bfloat16 has the same exponent range as float32, so only float16 needs loss scaling
+            optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
 
-    # Checkpointing
-    checkpoint_path = Path(flags.FLAGS.checkpoint_path)
-    ckpt = tf.train.Checkpoint(transformer_decoder=transformer_decoder, optimizer=optimizer,
-                               global_step=global_step, num_examples_processed=num_examples_processed)
-    ckpt_manager = tf.train.CheckpointManager(ckpt, str(checkpoint_path), max_to_keep=5)
-    if ckpt_manager.latest_checkpoint:
-        ckpt.restore(ckpt_manager.latest_checkpoint)
-        print("Restored checkpoint from: {}".format(ckpt_manager.latest_checkpoint))
+        # Counters
+        global_step = tf.Variable(0, name="global_step", trainable=False, dtype=tf.int64)
+        num_examples_processed = tf.Variable(0, name="num_examples_processed", trainable=False, dtype=tf.int64)
+
+        # Checkpointing
+        checkpoint_path = Path(flags.FLAGS.checkpoint_path)
+        ckpt = tf.train.Checkpoint(transformer_decoder=transformer_decoder, optimizer=optimizer,
+                                   global_step=global_step, num_examples_processed=num_examples_processed)
+        ckpt_manager = tf.train.CheckpointManager(ckpt, str(checkpoint_path), max_to_keep=5)
+        if ckpt_manager.latest_checkpoint:
+            ckpt.restore(ckpt_manager.latest_checkpoint)
+            print("Restored checkpoint from: {}".format(ckpt_manager.latest_checkpoint))
 
     # Tensorboard events
     train_log_dir = str(checkpoint_path / "events")
-    train_summary_writer = tf.summary.create_file_writer(train_log_dir)
+    train_summary_writer = tf.summary.create_file_writer(train_log_dir, flush_millis=10000, max_queue=10000)
 
     # Training dataset
     ds = get_dataset(Path(flags.FLAGS.data), hp.get("max_tokens"), hp.get("max_seq_len"), hp.get("shuffle_buffer"),
                      skip=global_step.numpy())
+    ds = strategy.experimental_distribute_dataset(ds)
+
+    trainer = Trainer(strategy, transformer_decoder, optimizer, learning_rate, global_step, train_summary_writer,
+                      flags.FLAGS.summarize_every, grad_accum_steps=hp.get("grad_accum_steps"))
 
     try:
-        train_loop(ds, transformer_decoder, global_step, num_examples_processed, ckpt_manager, optimizer,
-                   learning_rate, train_summary_writer, flags.FLAGS.checkpoint_every, flags.FLAGS.summarize_every,
-                   flags.FLAGS.continuous)
+        train_loop(ds, trainer, global_step, num_examples_processed, ckpt_manager,
+                   flags.FLAGS.checkpoint_every, flags.FLAGS.continuous)
     except KeyboardInterrupt:
         pass
 
@@ -16,8 +16,8 @@ parser.add_argument("--eval_test_args", default="", help="Arguments specific to
 
 args = parser.parse_args()
 
-train_data_path = str(args.data_dir / "train.encoded.jsonl")
-test_data_path = str(args.data_dir / "test.encoded.jsonl")
+train_data_path = str(args.data_dir / "train.encoded.tfrecord")
+test_data_path = str(args.data_dir / "test.encoded.tfrecord")
 vocab_path = str(args.data_dir / "vocab.subwords")
 
 